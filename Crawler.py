@@ -1,14 +1,51 @@
 from __future__ import annotations
 
 import asyncio
-import html.parser
-import pathlib
+import collections
+import csv
+import functools
+import random
+import re
+import sys
 import time
 import urllib.parse
 import pandas as pd
 from typing import Callable, Iterable
 
 import httpx  # https://github.com/encode/httpx
+import lxml.etree
+import lxml.html
+import pybloom_live
+
+
+PHASE_TIMES: dict[str, int] = collections.defaultdict(int)
+
+
+class Phase:
+    # accumulates wall-clock time per phase so the "Done in Xs" totals
+    # can be broken down into fetch/parse/etc.; cheap enough to leave on
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        PHASE_TIMES[self.name] += time.perf_counter_ns() - self.start
+
+
+def print_phase_times():
+    print("Phase times (summed across workers):")
+    for name, ns in sorted(PHASE_TIMES.items()):
+        print(f"  {name}: {ns / 1e9:.2f}s")
+
+
+def _timed_feed(parser, chunk):
+    # runs inside the worker thread, so only the actual parse is booked
+    # as "parse" - not the thread-pool and event-loop scheduling waits
+    with Phase("parse"):
+        parser.feed(chunk)
 
 
 class UrlFilterer:
@@ -18,86 +55,127 @@ class UrlFilterer:
             allowed_schemes: set[str] | None = None,
             allowed_filetypes: set[str] | None = None,
             blocked_phrases: set[str] | None = None,
+            required_substrings: set[str] | None = None,
     ):
-        self.allowed_domains = allowed_domains
-        self.allowed_schemes = allowed_schemes
-        self.allowed_filetypes = allowed_filetypes
+        # frozensets of interned strings: membership tests on the hot
+        # path hit CPython's identity fast path before comparing
+        self.allowed_domains = self._intern_set(allowed_domains)
+        self.allowed_schemes = self._intern_set(allowed_schemes)
+        self.allowed_filetypes = self._intern_set(allowed_filetypes)
         self.blocked_phrases = blocked_phrases
+        self.required_substrings = self._intern_set(required_substrings)
+        # one C-level scan per URL instead of a Python `in` per phrase
+        self.blocked_re = (
+            re.compile("|".join(map(re.escape, blocked_phrases)))
+            if blocked_phrases else None)
+
+    @staticmethod
+    def _intern_set(values: set[str] | None) -> frozenset[str] | None:
+        if values is None:
+            return None
+        return frozenset(sys.intern(s) for s in values)
 
+    # the same href shows up on page after page; cache the verdict
+    @functools.lru_cache(maxsize=100_000)
     def filter_url(self, base: str, url: str) -> str | None:
         url = urllib.parse.urljoin(base, url)
         url, _frag = urllib.parse.urldefrag(url)
         parsed = urllib.parse.urlparse(url)
         if (self.allowed_schemes is not None
-                and parsed.scheme not in self.allowed_schemes):
+                and sys.intern(parsed.scheme) not in self.allowed_schemes):
             return None
         if (self.allowed_domains is not None
-                and parsed.netloc not in self.allowed_domains):
+                and sys.intern(parsed.netloc) not in self.allowed_domains):
             return None
-        ext = pathlib.Path(parsed.path).suffix
+        # suffix of the last path segment, without a pathlib.Path detour
+        segment = parsed.path.rpartition('/')[2]
+        dot = segment.rfind('.')
+        ext = segment[dot:] if dot > 0 else ""
         if (self.allowed_filetypes is not None
                 and ext not in self.allowed_filetypes):
             return None
-        if (self.blocked_phrases is not None
-            and any([p in url for p in self.blocked_phrases])):
+        if (self.blocked_re is not None
+                and self.blocked_re.search(url) is not None):
             return None
-        return url
-
-
-class UrlParser(html.parser.HTMLParser):
+        return self.canonicalize(url)
+
+    def has_required(self, url: str) -> bool:
+        # which of the filtered URLs are worth fetching (e.g. pagination)
+        if self.required_substrings is None:
+            return True
+        return any(s in url for s in self.required_substrings)
+
+    @staticmethod
+    def canonicalize(url: str) -> str:
+        # lowercase the host, drop default ports and empty paths, sort
+        # query params - so trivially different spellings of the same
+        # URL dedup to one entry and one fetch
+        parts = urllib.parse.urlsplit(url)
+        netloc = (parts.hostname or "").lower()
+        if parts.port is not None and parts.port not in (80, 443):
+            netloc += f":{parts.port}"
+        query = urllib.parse.urlencode(sorted(
+            urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+        path = parts.path or "/"
+        return urllib.parse.urlunsplit(
+            (parts.scheme.lower(), netloc, path, query, ""))
+
+
+class TokenBucket:
+    # refills `rate` tokens per second up to `burst`; one token per request
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.max_rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        while True:
+            async with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    # AIMD: halve the rate when the server pushes back, creep back up
+    # towards the configured rate while requests succeed
+    def backoff(self):
+        self.rate = max(self.rate / 2, 0.5)
+
+    def recover(self):
+        self.rate = min(self.rate + 0.1, self.max_rate)
+
+
+class LinkTarget:
+    # lxml parser target: collects filtered <a href> links as the
+    # document streams in, so the whole body is never buffered
     def __init__(
             self,
             base: str,
             filter_url: Callable[[str, str], str | None]
     ):
-        super().__init__()
         self.base = base
         self.filter_url = filter_url
         self.found_links = set()
 
-    def handle_starttag(self, tag: str, attrs):
-        # look for <a href="...">
+    def start(self, tag: str, attrs):
         if tag != "a":
             return
 
-        for attr, url in attrs:
-            if attr != "href":
-                continue
-
-            if (url := self.filter_url(self.base, url)) is not None:
-                self.found_links.add(url)
-
+        url = attrs.get("href")
+        if url is not None and (url := self.filter_url(self.base, url)) is not None:
+            self.found_links.add(url)
 
-class SpellParser(html.parser.HTMLParser):
-    def __init__(self) -> None:
-        self.name = ""
-        self.description =""
-        self.capture_desc = False
-        self.capture_name = False
-        super().__init__()
+    def close(self):
+        return self.found_links
 
-    def handle_endtag(self, tag):
-        if tag not in ('div', 'h1'):
-            return
-
-        self.capture_desc = False
-        self.capture_name = False
-
-    def handle_data(self, data: str) -> None:
-        if self.capture_name:
-            self.name = data.strip()
-        elif self.capture_desc:
-            self.description = data.strip()
-           
-    def handle_starttag(self, tag, attrs) -> None:
-        if tag not in ('div', 'h1'):
-            return
-
-        if ('class','codex-page-description') in attrs:
-            self.capture_desc = True
-        elif ('class', 'herotext') in attrs:
-            self.capture_name = True
-        
 
 class Crawler:
     def __init__(
@@ -107,25 +185,38 @@ class Crawler:
             filter_url: Callable[[str, str], str | None],
             workers: int = 10,
             limit: int = 25,
+            should_crawl: Callable[[str], bool] | None = None,
     ):
         self.client = client
 
-        self.start_urls = set(urls)
-        self.todo = asyncio.Queue()
-        self.seen = set()
+        self.urls = urls
+        # bounded queue back-pressures producers on high-fanout pages
+        self.todo = asyncio.Queue(maxsize=10_000)
+        self.sem = asyncio.Semaphore(20)
+        # Bloom filter holds ~10 bits per URL instead of the full string
+        self.seen = pybloom_live.ScalableBloomFilter(
+            initial_capacity=1 << 16, error_rate=1e-4)
+        self.found_urls: list[str] = []
         self.done = set()
 
         self.filter_url = filter_url
+        self.should_crawl = should_crawl
+        self.limiter = TokenBucket(rate=5, burst=5)
         self.num_workers = workers
         self.limit = limit
         self.total = 0
 
     async def run(self):
-        await self.on_found_links(self.start_urls)  # prime the queue
+        # workers start first so priming can back-pressure against them
+        # when the url list is larger than the queue
         workers = [
             asyncio.create_task(self.worker())
             for _ in range(self.num_workers)
         ]
+        # prime the queue one URL at a time; works for generators (e.g.
+        # a streamed sitemap) without materializing them
+        for url in self.urls:
+            await self.on_found_links((url,))
         await self.todo.join()
 
         for worker in workers:
@@ -143,49 +234,105 @@ class Crawler:
         try:
             await self.crawl(url)
         except Exception as exc:
-            # retry handling here...
-            pass
+            print(f"Giving up on {url}: {exc!r}")
         finally:
             self.todo.task_done()
 
     async def crawl(self, url: str):
+        for attempt in range(5):
+            await self.limiter.acquire()
+            retry_in = None
+            try:
+                # "fetch" spans the streamed request, so the in-stream
+                # "parse" share is a subset of it
+                with Phase("fetch"):
+                    async with self.sem, self.client.stream("GET", url, follow_redirects=True) as response:
+                        if response.status_code == 429:
+                            self.limiter.backoff()
+                            retry_in = self.retry_after(response, attempt)
+                        else:
+                            target = LinkTarget(str(response.url), self.filter_url)
+                            parser = lxml.etree.HTMLParser(target=target)
+                            async for chunk in response.aiter_bytes(65536):
+                                # lxml releases the GIL, so other workers keep
+                                # reading sockets while this chunk parses
+                                await asyncio.to_thread(_timed_feed, parser, chunk)
+                            try:
+                                parser.close()
+                            except lxml.etree.XMLSyntaxError:
+                                # empty body (e.g. a 204); nothing to collect
+                                pass
+            except httpx.TransportError:  # includes timeouts
+                await asyncio.sleep(min(2 ** attempt, 30))
+                continue
+            if retry_in is not None:
+                # server backoff is waiting, not fetching
+                await asyncio.sleep(retry_in)
+                continue
+            self.limiter.recover()
+            break
+        else:
+            print(f"Giving up on {url}: retries exhausted")
+            return
 
-        # rate limit here...
-        await asyncio.sleep(.2)
-
-        response = await self.client.get(url, follow_redirects=True)
-
-        found_links = await self.parse_links(
-            base=str(response.url),
-            text=response.text,
-        )
-
-        await self.on_found_links(found_links)
+        await self.on_found_links(target.found_links)
 
         self.done.add(url)
 
-    async def parse_links(self, base: str, text: str) -> set[str]:
-        parser = UrlParser(base, self.filter_url)
-        parser.feed(text)
-        return parser.found_links
+    async def fetch(self, url: str) -> httpx.Response | None:
+        # GET with the same backoff policy as crawl, for buffered bodies
+        for attempt in range(5):
+            await self.limiter.acquire()
+            try:
+                with Phase("fetch"):
+                    async with self.sem:
+                        response = await self.client.get(url, follow_redirects=True)
+            except httpx.TransportError:
+                await asyncio.sleep(min(2 ** attempt, 30))
+                continue
+            if response.status_code == 429:
+                self.limiter.backoff()
+                await asyncio.sleep(self.retry_after(response, attempt))
+                continue
+            self.limiter.recover()
+            return response
+        print(f"Giving up on {url}: retries exhausted")
+        return None
+
+    @staticmethod
+    def retry_after(response: httpx.Response, attempt: int) -> float:
+        value = response.headers.get("retry-after")
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+        return min(2 ** attempt, 30) + random.random()
 
-    async def on_found_links(self, urls: set[str]):
-        new = urls - self.seen
-        self.seen.update(new)
+    async def on_found_links(self, urls: Iterable[str]):
+        new = [url for url in urls if url not in self.seen]
+        for url in new:
+            self.seen.add(url)
+        self.found_urls.extend(new)
 
         # await save to database or file here...
-       
+
         for url in new:
             await self.put_todo(url)
 
     async def put_todo(self, url: str):
         if self.total >= self.limit:
             return
-        if '?p=' not in url:
+        if self.should_crawl is not None and not self.should_crawl(url):
             return
 
         self.total += 1
-        await self.todo.put(url)
+        # fast path skips an event-loop trip per URL; a full queue falls
+        # back to the awaiting put, which is the back-pressure mechanism
+        try:
+            self.todo.put_nowait(url)
+        except asyncio.QueueFull:
+            await self.todo.put(url)
 
 
 def save_spell_urls(spells):
@@ -196,51 +343,107 @@ def save_spell_urls(spells):
 
 
 class SpellReader(Crawler):
-    def __init__(self, client: httpx.AsyncClient, urls: Iterable[str], langs: Iterable[str], workers: int = 10, ):#
+    def __init__(self, client: httpx.AsyncClient, urls: Iterable[str], langs: Iterable[str], workers: int = 10,
+                 csv_path: str | None = 'skills.csv'):
         self.langs = langs
-        self.entries = []
+        self.entries: list[dict] = []
+        self.csv_path = csv_path
+        self.writer: csv.DictWriter | None = None
         super().__init__(client, urls, None, workers, limit=len(urls))
 
+    async def run(self):
+        if self.csv_path is None:
+            return await super().run()
 
-    async def parse_spell_info(self, text: str) -> set[str]:
-        parser = SpellParser()
-        parser.feed(text)
-        return parser.name, parser.description
+        # stream rows out as they complete instead of serializing
+        # everything at the end; a crash still leaves a usable file
+        fieldnames = ['url']
+        for lang in self.langs:
+            fieldnames += [f'name_{lang}', f'desc_{lang}']
+        with open(self.csv_path, 'w', newline='') as fp:
+            self.writer = csv.DictWriter(fp, fieldnames=fieldnames)
+            self.writer.writeheader()
+            try:
+                await super().run()
+            finally:
+                self.writer = None
+
+
+    @staticmethod
+    def _parse_spell_info(text: str) -> tuple[str, str]:
+        # fromstring raises on an empty body; report empty fields like
+        # the old SpellParser did
+        if not text.strip():
+            return "", ""
+        # one C-level pass over the document; the old SpellParser scanned
+        # every div/h1's attr list in Python
+        with Phase("parse"):
+            tree = lxml.html.fromstring(text)
+            name = tree.xpath('string(//h1[@class="herotext"])').strip()
+            desc = tree.xpath(
+                'string(//div[@class="codex-page-description"])').strip()
+        return name, desc
+
+    async def parse_spell_info(self, text: str) -> tuple[str, str]:
+        return await asyncio.to_thread(self._parse_spell_info, text)
+
+    async def _fetch_lang(self, url: str, lang: str) -> tuple[str, str, str]:
+        response = await self.fetch(f"{url}?lang={lang}")
+        if response is None:
+            return lang, "", ""
+        name, desc = await self.parse_spell_info(response.text)
+        return lang, name, desc
 
     async def crawl(self, url):
-        await asyncio.sleep(.2)
+        # the per-language requests are independent, so fire them together;
+        # the token bucket still caps the overall request rate
+        results = await asyncio.gather(
+            *(self._fetch_lang(url, lang) for lang in self.langs))
 
-        df = pd.DataFrame()
-        df['url'] = [url]
-        for lang in self.langs:
-            response = await self.client.get(f"{url}?lang={lang}", follow_redirects=True)
-            name, desc = await self.parse_spell_info(response.text)
-            df[f'name_{lang}'] = name
-            df[f'desc_{lang}'] = desc
+        row = {'url': url}
+        for lang, name, desc in results:
+            row[f'name_{lang}'] = name
+            row[f'desc_{lang}'] = desc
 
-        self.entries.append(df)
-        pass
+        self.entries.append(row)
+        if self.writer is not None:
+            self.writer.writerow(row)
 
     async def put_todo(self, url: str):
         if self.total >= self.limit:
             return
 
         self.total += 1
-        await self.todo.put(url)
+        try:
+            self.todo.put_nowait(url)
+        except asyncio.QueueFull:
+            await self.todo.put(url)
+
+def make_client() -> httpx.AsyncClient:
+    # one client for the whole run: HTTP/2 multiplexes the same-host
+    # requests over a single connection and keep-alive skips repeated
+    # TLS handshakes (needs httpx[http2])
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(10.0),
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+        headers={"user-agent": "AethricCrawler/1.0"},
+    )
 
-async def get_spells(spell_urls, langs):
+
+async def get_spells(client, spell_urls, langs):
     start = time.perf_counter()
-    async with httpx.AsyncClient() as client:
-        crawler = SpellReader(
-            client=client,
-            urls=spell_urls,
-            workers=5,
-            langs = langs
-        )
-        await crawler.run()
+    crawler = SpellReader(
+        client=client,
+        urls=spell_urls,
+        workers=5,
+        langs = langs
+    )
+    await crawler.run()
     end = time.perf_counter()
     print(f"Done in {end - start:.2f}s")
-    df = pd.concat(crawler.entries).sort_values('name_en')
+    with Phase("dataframe"):
+        df = pd.DataFrame.from_records(crawler.entries).sort_values('name_en')
     return df
 
 
@@ -249,11 +452,12 @@ async def main():
         allowed_domains={"playorna.com"},
         allowed_schemes={"http", "https"},
         allowed_filetypes={".html", ".php", ""},
-        blocked_phrases={ "lang","releases/"}
+        blocked_phrases={ "lang","releases/"},
+        required_substrings={"?p="},
     )
 
     start = time.perf_counter()
-    async with httpx.AsyncClient() as client:
+    async with make_client() as client:
         crawler = Crawler(
             client=client,
             urls=["https://playorna.com/codex/spells/",
@@ -261,26 +465,28 @@ async def main():
             filter_url=filterer.filter_url,
             workers=5,
             limit=250,
+            should_crawl=filterer.has_required,
         )
         await crawler.run()
-    end = time.perf_counter()
+        end = time.perf_counter()
 
-    seen = sorted(crawler.seen)
-    print("Results:")
-    for url in seen:
-        print(url)
-    print(f"Crawled: {len(crawler.done)} URLs")
-    print(f"Found: {len(seen)} URLs")
-    print(f"Done in {end - start:.2f}s")
+        seen = sorted(crawler.found_urls)
+        print("Results:")
+        for url in seen:
+            print(url)
+        print(f"Crawled: {len(crawler.done)} URLs")
+        print(f"Found: {len(seen)} URLs")
+        print(f"Done in {end - start:.2f}s")
+
+        spell_urls = [s for s in seen if 'spells' in s and 'lang' not in s]
+        spell_urls.sort()
 
-    spell_urls = [s for s in seen if 'spells' in s and 'lang' not in s]
-    spell_urls.sort()
+        langs = ['en', 'de']
 
-    langs = ['en', 'de']
+        df = await get_spells(client, spell_urls, langs)
+        df.to_excel('skills.xlsx')
 
-    df = await get_spells(spell_urls, langs)
-    df.to_excel('skills.xlsx')
-    pass
+    print_phase_times()
 
 
 if __name__ == '__main__':